@@ -3,18 +3,35 @@ import sys
 import struct
 import json
 import binascii
+import base64
 import gzip
-import urllib2
+import httplib
+import socket
+import urllib
+import urlparse
+from contextlib import closing
 from StringIO import StringIO
 import subprocess
 import hashlib
+import errno
 import tempfile
 import shutil
 import platform
+import threading
+import Queue
+import time
+import collections
 
 if platform.system() == 'Windows':
     import win32con
     import win32api
+    import win32file
+    import msvcrt
+else:
+    import fcntl
+    if platform.system() == 'Linux':
+        import ctypes
+        import ctypes.util
 
 programName = 'ChoiDujour'
 programVersion = '1.1.0'
@@ -51,25 +68,62 @@ def print_welcome():
 def print_usage():
     print_welcome()
     print('Usage:')
-    print('ChoiDujour [--help] [--dev] [--keyset=path/to/keys.txt] [--noexfat] [--nossl]   [--fspatches=nocmac,nogc] [--intype=xci/nca/romfs/hfs0] firmwareSrc')
+    print('ChoiDujour [--help] [--dev] [--keyset=path/to/keys.txt] [--noexfat] [--bothexfat] [--nossl]   [--mirrors=url1,url2] [--timeout=secs] [--cachedir=path] [--cachesize=MB] [--fspatches=nocmac,nogc] [--intype=xci/nca/romfs/hfs0] [--outdir=path] [--copythreads=N] [--delta=path] [--emmc=path] [--boot0=path] [--boot1=path] [--rawnand=path] firmwareSrc')
+    print('ChoiDujour [--dev] [--keyset=path/to/keys.txt] [--intype=xci/nca/romfs/hfs0] --identify firmwareSrc [firmwareSrc...]')
+    print('ChoiDujour [options] --watch=path/to/folder [--workers=N] [--outdir=path]')
     print('')
     print('Parameters: ')
     print('--help\t\tdisplay this usage message')
     print('--dev\t\ttell hactool to use dev instead of production keys')
     print('--keyset=path\toverride default hactool keys txt file path')
     print('--noexfat\talways generate normal BCPKG2/FS.kip1 (no exfat support)')
+    print('--bothexfat\tgenerate both the normal and the _exfat output folder in one go')
     print('--nossl\t\tuse http instead of https protocol for web requests')
+    print('--mirrors=list\tcomma separated list of server base URLs, file:// URLs or local folders to fetch from')
+    print('--timeout=secs\tnetwork timeout for web requests in seconds (default: 30)')
+    print('--cachedir=path\tfolder for downloaded archives, can be shared between runs (default: temp folder)')
+    print('--cachesize=MB\tevict least recently used archives beyond this size, 0 for no limit (default: 2048)')
     print('--fspatches\tcomma separated list of patches to apply to generated FS.kip1')
     print('--intype=type\tfirmware package file type (Ignored if firmwareSrc is a folder)')
+    print('--identify\tonly print the firmware version of each firmwareSrc as a line of JSON')
+    print('\t\t(xci/hfs0 are read in place, nca/romfs still get extracted; exfat is null if not found quickly)')
+    print('--outdir=path\tfolder to create the output firmware folder in (default: current folder)')
+    print('--copythreads=N\tnumber of NCAs to copy into the output at once (default: 4)')
+    print('--delta=path\tonly output files added or changed since this earlier output folder (or its manifest.json)')
+    print('--emmc=path\twrite BOOT0/BOOT1/BCPKG2 straight into this raw eMMC image (BOOT0+BOOT1+user area)')
+    print('--boot0=path\twrite BOOT0 straight into this BOOT0 image instead of BOOT0.bin')
+    print('--boot1=path\twrite BOOT1 straight into this BOOT1 image instead of BOOT1.bin')
+    print('--rawnand=path\twrite BCPKG2 partitions straight into this rawnand image instead of BCPKG2-*.bin')
+    print('--watch=path\tdaemon mode, convert every .xci/.hfs0/.nca file or update folder put into this folder')
+    print('--workers=N\tnumber of conversions to run at once in --watch mode (default: 2)')
     print('firmwareSrc\tpath to source firmware package file or folder')
     print('')
 
 hackeyspath = ''
 hacisDev = False
 try_exfat = True
+build_both = False
 http_only = False
+serverBaseUrl = 'https://switchtools.sshnuke.net'
+mirrorUrls = [serverBaseUrl]
+mirrorProbePath = 'firmware/fs_patches.json'
+mirrorRerankSeconds = 600
+httpTimeout = 30
 wanted_patches = ['nocmac', 'nogc']
 
+outBaseDir = ''
+watchDir = ''
+numWorkers = 2
+numCopyThreads = 4
+cacheDir = os.path.join(tempfile.gettempdir(), programName)
+cacheMaxBytes = 2048*1024*1024
+deltaBasePath = ''
+identifyOnly = False
+emmcImagePath = ''
+boot0ImagePath = ''
+boot1ImagePath = ''
+rawnandImagePath = ''
+
 myParams = []
 inputFiles = []
 inFileType = ''
@@ -88,10 +142,28 @@ try:
             sys.exit()
         elif currParam == '--dev':
             hacisDev = True
+        elif currParam == '--identify':
+            identifyOnly = True
         elif currParam == '--noexfat':
             try_exfat = False
+        elif currParam == '--bothexfat':
+            build_both = True
         elif currParam == '--nossl':
             http_only = True
+        elif currParam.startswith('--mirrors='):
+            mirrorUrls = []
+            for mirrorUrl in currParam[10:].split(','):
+                if len(mirrorUrl.strip()) > 0:
+                    mirrorUrls += [mirrorUrl.strip()]
+            if len(mirrorUrls) == 0:
+                sys.exit('No mirrors specified in ' + currParam)
+        elif currParam.startswith('--timeout='):
+            try:
+                httpTimeout = float(currParam[10:])
+            except ValueError:
+                httpTimeout = 0
+            if httpTimeout <= 0:
+                sys.exit('Invalid network timeout ' + currParam[10:])
         elif currParam.startswith('--keyset='):
             hackeyspath = currParam[9:]
         elif currParam.startswith('--intype='):
@@ -99,6 +171,43 @@ try:
             validTypes = ['nca', 'xci', 'romfs', 'hfs0']
             if inFileType not in validTypes:
                 sys.exit('Invalid input file type ' + inFileType + ' (supported: ' + ",".join(validTypes) + ')')
+        elif currParam.startswith('--outdir='):
+            outBaseDir = currParam[9:]
+        elif currParam.startswith('--emmc='):
+            emmcImagePath = currParam[7:]
+        elif currParam.startswith('--boot0='):
+            boot0ImagePath = currParam[8:]
+        elif currParam.startswith('--boot1='):
+            boot1ImagePath = currParam[8:]
+        elif currParam.startswith('--rawnand='):
+            rawnandImagePath = currParam[10:]
+        elif currParam.startswith('--watch='):
+            watchDir = currParam[8:]
+        elif currParam.startswith('--workers='):
+            try:
+                numWorkers = int(currParam[10:])
+            except ValueError:
+                numWorkers = 0
+            if numWorkers < 1:
+                sys.exit('Invalid number of workers ' + currParam[10:])
+        elif currParam.startswith('--copythreads='):
+            try:
+                numCopyThreads = int(currParam[14:])
+            except ValueError:
+                numCopyThreads = 0
+            if numCopyThreads < 1:
+                sys.exit('Invalid number of copy threads ' + currParam[14:])
+        elif currParam.startswith('--delta='):
+            deltaBasePath = currParam[8:]
+        elif currParam.startswith('--cachedir='):
+            cacheDir = currParam[11:]
+        elif currParam.startswith('--cachesize='):
+            try:
+                cacheMaxBytes = int(currParam[12:])*1024*1024
+            except ValueError:
+                cacheMaxBytes = -1
+            if cacheMaxBytes < 0:
+                sys.exit('Invalid download cache size ' + currParam[12:])
         elif currParam.startswith('--fspatches='):
             selectedPatchesStr = currParam[12:].strip().lower()
             wanted_patches = []
@@ -109,7 +218,34 @@ try:
         else:
             sys.exit('Unknown parameter specified: ' + currParam)
 
-    if len(inputFiles) != 1:
+    for imagePath in [emmcImagePath, boot0ImagePath, boot1ImagePath, rawnandImagePath]:
+        if (len(imagePath) > 0) and not os.path.isfile(imagePath):
+            sys.exit('eMMC image file ' + imagePath + " doesn't exist!")
+
+    if build_both and not try_exfat:
+        sys.exit('--bothexfat and --noexfat cannot be used together')
+    if build_both and len(emmcImagePath + boot0ImagePath + boot1ImagePath + rawnandImagePath) > 0:
+        sys.exit('eMMC image parameters cannot be used together with --bothexfat')
+
+    if identifyOnly:
+        if build_both or (len(watchDir) > 0) or (len(deltaBasePath) > 0) or (len(emmcImagePath + boot0ImagePath + boot1ImagePath + rawnandImagePath) > 0):
+            sys.exit('--identify cannot be used together with --watch, --delta, --bothexfat or eMMC image parameters')
+
+    if len(deltaBasePath) > 0:
+        if not os.path.exists(deltaBasePath):
+            sys.exit('Delta base ' + deltaBasePath + " doesn't exist!")
+        if build_both or (len(watchDir) > 0):
+            sys.exit('--delta cannot be used together with --bothexfat or --watch')
+
+    if len(watchDir) > 0:
+        if len(inputFiles) != 0:
+            sys.exit('No input firmware file/folder arguments are allowed in --watch mode')
+        if len(emmcImagePath + boot0ImagePath + boot1ImagePath + rawnandImagePath) > 0:
+            sys.exit('eMMC image parameters cannot be used in --watch mode')
+    elif identifyOnly:
+        if len(inputFiles) == 0:
+            sys.exit('Please specify input firmware file/folder!')
+    elif len(inputFiles) != 1:
         if len(inputFiles) == 0:
             sys.exit('Please specify input firmware file/folder!')
         else:
@@ -154,41 +290,233 @@ def deunicodify_hook(pairs):
 def get_sha256_file_digest(fname):
     return hash_bytestr_iter(file_as_blockiter(open(fname, 'rb')), hashlib.sha256(), ashexstr=True)
 
-def fetch_url_bytes(url, gzipped=True):
+class HttpError(Exception):
+    def __init__(self, url, code, reason):
+        Exception.__init__(self, 'HTTP Error ' + str(code) + ' (' + str(reason) + ') for URL ' + url)
+        self.url = url
+        self.code = code
+
+def apply_nossl(url):
     if http_only and url.startswith('https:'):
         url = 'http:' + url[6:]
+    return url
+
+class HttpConnectionPool(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.local = threading.local() #httplib connections can't be shared between threads
+
+    def getConnections(self):
+        if not hasattr(self.local, 'conns'):
+            self.local.conns = {}
+        return self.local.conns
+
+    def discard(self, key):
+        conn = self.getConnections().pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def proxyFor(self, scheme, host):
+        proxyUrl = urllib.getproxies().get(scheme)
+        if (proxyUrl is None) or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxyUrl:
+            proxyUrl = 'http://' + proxyUrl
+        return urlparse.urlsplit(proxyUrl)
+
+    def open(self, url, method='GET', headers={}, redirects=5):
+        url = apply_nossl(url)
+        parts = urlparse.urlsplit(url)
+        reqPath = parts.path if len(parts.path) > 0 else '/'
+        if len(parts.query) > 0:
+            reqPath += '?' + parts.query
+
+        #same proxy settings urllib2's default ProxyHandler would use
+        proxy = self.proxyFor(parts.scheme, parts.hostname)
+        reqHeaders = dict(headers)
+        if proxy is None:
+            key = (parts.scheme, parts.netloc)
+        else:
+            proxyHost = proxy.hostname
+            if proxy.port is not None:
+                proxyHost += ':' + str(proxy.port)
+            proxyAuth = {}
+            if proxy.username is not None:
+                proxyAuth['Proxy-Authorization'] = 'Basic ' + base64.b64encode(urllib.unquote(proxy.username) + ':' + urllib.unquote(proxy.password or ''))
+            if parts.scheme == 'https':
+                key = (parts.scheme, parts.netloc, proxyHost) #tunnel is bound to the target host
+            else:
+                key = (parts.scheme, proxyHost)
+                reqPath = urlparse.urlunsplit((parts.scheme, parts.netloc, reqPath, '', ''))
+                reqHeaders.update(proxyAuth)
 
-    print('Making a request to URL ' + url)
-    request = urllib2.Request(url)
-    if gzipped:
-        request.add_header('Accept-encoding', 'gzip')
+        conns = self.getConnections()
+        while True:
+            conn = conns.get(key)
+            reused = conn is not None
+            if not reused:
+                if proxy is None:
+                    if parts.scheme == 'https':
+                        conn = httplib.HTTPSConnection(parts.netloc, timeout=self.timeout)
+                    else:
+                        conn = httplib.HTTPConnection(parts.netloc, timeout=self.timeout)
+                elif parts.scheme == 'https':
+                    conn = httplib.HTTPSConnection(proxyHost, timeout=self.timeout)
+                    conn.set_tunnel(parts.hostname, parts.port, proxyAuth)
+                else:
+                    conn = httplib.HTTPConnection(proxyHost, timeout=self.timeout)
+                conns[key] = conn
+            try:
+                conn.request(method, reqPath, headers=reqHeaders)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                self.discard(key)
+                if not reused:
+                    raise
+                #server closed the kept-alive connection in the meantime, retry on a new one
 
-    response = urllib2.urlopen(request)
-    if response.info().get('Content-Encoding') == 'gzip':
-        buf = StringIO(response.read())
-        f = gzip.GzipFile(fileobj=buf)
-        return f.read()
-    else:
-        return response.read()
+        if response.status in [301, 302, 303, 307, 308]:
+            location = response.getheader('Location')
+            response.read()
+            if (location is None) or (redirects == 0):
+                raise HttpError(url, response.status, 'bad redirect')
+            return self.open(urlparse.urljoin(url, location), method, headers, redirects-1)
 
-def download_large_file(url, outFilename):
-    if http_only and url.startswith('https:'):
-        url = 'http:' + url[6:]
+        if response.status != 200:
+            response.read()
+            raise HttpError(url, response.status, response.reason)
 
-    print('Downloading file from URL ' + url)
-    remote_file = urllib2.urlopen(url)
-    total_size = None
-    header = None
-    try:
-        total_size = remote_file.info().getheader('Content-Length').strip()
-        header = True
-    except AttributeError:
-        header = False # a response doesn't always include the "Content-Length" header
+        return response
+
+httpPool = HttpConnectionPool(httpTimeout)
 
-    if header:
-        total_size = int(total_size)
+def local_mirror_path(baseUrl):
+    if baseUrl.startswith('file:'):
+        return urllib.url2pathname(urlparse.urlsplit(baseUrl).path)
+    elif '://' not in baseUrl:
+        return baseUrl
 
-    with open(outFilename, 'wb') as outputFile:
+    return None
+
+class MirrorSource(object):
+    def __init__(self, baseUrl):
+        self.baseUrl = baseUrl.rstrip('/')
+        self.localPath = local_mirror_path(self.baseUrl)
+
+    def open(self, relPath, gzipped):
+        if self.localPath is not None:
+            filePath = os.path.join(self.localPath, *relPath.split('/'))
+            if not os.path.isfile(filePath):
+                raise HttpError(self.baseUrl + '/' + relPath, 404, 'Not Found')
+            return [open(filePath, 'rb'), os.path.getsize(filePath), None, filePath]
+
+        headers = {}
+        if gzipped:
+            headers['Accept-encoding'] = 'gzip'
+        requestUrl = apply_nossl(self.baseUrl + '/' + relPath)
+        response = httpPool.open(requestUrl, headers=headers)
+        totalSize = response.getheader('Content-Length')
+        if totalSize is not None:
+            totalSize = int(totalSize.strip())
+        return [response, totalSize, response.getheader('Content-Encoding'), requestUrl]
+
+    def probe(self):
+        if self.localPath is not None:
+            if not os.path.isdir(self.localPath):
+                raise HttpError(self.baseUrl, 404, 'Not a folder')
+            return
+
+        response = httpPool.open(self.baseUrl + '/' + mirrorProbePath, method='HEAD')
+        response.read()
+
+class MirrorList(object):
+    def __init__(self, baseUrls):
+        self.mirrors = [MirrorSource(baseUrl) for baseUrl in baseUrls]
+        self.rankedAt = None
+        self.lock = threading.Lock()
+
+    def rank(self):
+        if len(self.mirrors) < 2:
+            return
+
+        latencies = {}
+        for mirror in self.mirrors:
+            startTime = time.time()
+            try:
+                mirror.probe()
+                latencies[mirror] = time.time() - startTime
+                print('Mirror ' + mirror.baseUrl + ' responded in ' + ('%0.3f' % latencies[mirror]) + ' seconds')
+            except (HttpError, httplib.HTTPException, socket.error, IOError), e:
+                latencies[mirror] = float('inf')
+                print('Mirror ' + mirror.baseUrl + ' is not healthy: ' + str(e))
+
+        self.mirrors.sort(key=lambda mirror: latencies[mirror])
+
+    def ordered(self):
+        with self.lock:
+            if (self.rankedAt is None) or (time.time() - self.rankedAt > mirrorRerankSeconds):
+                self.rank()
+                self.rankedAt = time.time()
+            return list(self.mirrors)
+
+    def demote(self, mirror):
+        with self.lock:
+            if mirror in self.mirrors:
+                self.mirrors.remove(mirror)
+                self.mirrors.append(mirror)
+
+    def relativePath(self, url):
+        for baseUrl in [serverBaseUrl] + [mirror.baseUrl for mirror in self.mirrors]:
+            if url.startswith(baseUrl + '/'):
+                return url[len(baseUrl)+1:]
+
+        return None
+
+    def open(self, url, gzipped):
+        relPath = self.relativePath(url)
+        if relPath is None:
+            return MirrorSource(url.rsplit('/', 1)[0]).open(url.rsplit('/', 1)[1], gzipped)
+
+        notFound = None
+        lastError = None
+        for mirror in self.ordered():
+            try:
+                return mirror.open(relPath, gzipped)
+            except HttpError, e:
+                if e.code == 404:
+                    notFound = e
+                    continue
+                lastError = e
+            except (httplib.HTTPException, socket.error, IOError), e:
+                lastError = e
+
+            print('Mirror ' + mirror.baseUrl + ' failed (' + str(lastError) + '), trying the next one')
+            self.demote(mirror)
+
+        if lastError is None:
+            raise notFound #every mirror answered that it doesn't have it
+        raise lastError
+
+mirrorList = MirrorList(mirrorUrls)
+
+def fetch_url_bytes(url, gzipped=True):
+    response, totalSize, encoding, servedFrom = mirrorList.open(url, gzipped)
+    print('Making a request to URL ' + servedFrom)
+    with closing(response):
+        if encoding == 'gzip':
+            buf = StringIO(response.read())
+            f = gzip.GzipFile(fileobj=buf)
+            return f.read()
+        else:
+            return response.read()
+
+def download_large_file(url, outFilename):
+    remote_file, total_size, encoding, servedFrom = mirrorList.open(url, False)
+    print('Downloading file from URL ' + servedFrom)
+    header = total_size is not None # a response doesn't always include the "Content-Length" header
+
+    with closing(remote_file), open(outFilename, 'wb') as outputFile:
         bytes_so_far = 0
         while True:
             buffer = remote_file.read(128*1024)
@@ -207,6 +535,39 @@ def download_large_file(url, outFilename):
             sys.stdout.write("Downloaded %d of %d bytes (%0.2f%%)\r" % (bytes_so_far, total_size, percent))
             sys.stdout.flush()
 
+fsPatchesCache = {}
+firmwareIndexCache = {}
+webCacheSeconds = 600
+webCacheLock = threading.Lock()
+
+def get_fs_patches(notBefore=0):
+    with webCacheLock:
+        cached = fsPatchesCache.get('patches')
+        if (cached is None) or (cached[0] < notBefore) or (time.time() - cached[0] > webCacheSeconds):
+            fetchedAt = time.time()
+            fsPatchesJsonBytes = fetch_url_bytes(serverBaseUrl + '/firmware/fs_patches.json')
+            fsPatchesCache['patches'] = [fetchedAt, json.loads(fsPatchesJsonBytes, object_hook=deunicodify_hook)]
+
+        return fsPatchesCache['patches'][1]
+
+def get_firmware_index(versionHash, exfat):
+    patchesJsonUrl = serverBaseUrl + '/firmware/'+versionHash
+    if exfat:
+        patchesJsonUrl += '_exfat'
+    patchesJsonUrl += '.json'
+
+    with webCacheLock:
+        for cachedUrl in firmwareIndexCache.keys():
+            if time.time() - firmwareIndexCache[cachedUrl][0] > webCacheSeconds:
+                del firmwareIndexCache[cachedUrl]
+
+        if patchesJsonUrl not in firmwareIndexCache:
+            fetchedAt = time.time()
+            firmwareIndexCache[patchesJsonUrl] = [fetchedAt, fetch_url_bytes(patchesJsonUrl)]
+
+        #parsed fresh every time as the caller converts the entries in place
+        return json.loads(firmwareIndexCache[patchesJsonUrl][1], object_hook=deunicodify_hook)
+
 hacargs = []
 if hacisDev:
     hacargs += ['--dev']
@@ -243,6 +604,299 @@ def realtime_run(totalArgs):
     else:
         raise subprocess.CalledProcessError(exitCode, " ".join(totalArgs), output)
 
+FICLONE = 0x40049409
+copyBufferSize = 4*1024*1024
+kernelCopyFuncs = []
+
+if platform.system() == 'Linux':
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if hasattr(libc, 'copy_file_range'):
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+        kernelCopyFuncs += [['copy_file_range', lambda srcFd, dstFd, count: libc.copy_file_range(srcFd, None, dstFd, None, count, 0)]]
+    if hasattr(libc, 'sendfile'):
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        libc.sendfile.restype = ctypes.c_ssize_t
+        kernelCopyFuncs += [['sendfile', lambda srcFd, dstFd, count: libc.sendfile(dstFd, srcFd, None, count)]]
+
+def kernel_copy_file(srcFile, dstFile, totalSize):
+    for funcName, copyFunc in kernelCopyFuncs:
+        copied = 0
+        while copied < totalSize:
+            result = copyFunc(srcFile.fileno(), dstFile.fileno(), min(totalSize - copied, 0x40000000))
+            if result < 0:
+                errNum = ctypes.get_errno()
+                if (copied == 0) and (errNum in [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]):
+                    break #not supported for this pair of files, nothing written yet so try the next way
+                raise OSError(errNum, os.strerror(errNum))
+            elif result == 0:
+                if copied == 0:
+                    break #some filesystems report 0 instead of an error when they can't do it
+                raise IOError('Source file ' + srcFile.name + ' shrank while copying')
+            copied += result
+
+        if copied == totalSize:
+            return funcName
+
+    return None
+
+def copy_file_contents(srcPath, dstPath):
+    if platform.system() == 'Windows':
+        win32file.CopyFile(srcPath, dstPath, 0) #lets the OS do server side copies and block cloning
+        return 'CopyFile'
+
+    with open(srcPath, 'rb') as srcFile, open(dstPath, 'wb') as dstFile:
+        if platform.system() == 'Linux':
+            try:
+                fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+                return 'reflink'
+            except IOError:
+                pass
+
+            methodName = kernel_copy_file(srcFile, dstFile, os.fstat(srcFile.fileno()).st_size)
+            if methodName is not None:
+                return methodName
+
+        shutil.copyfileobj(srcFile, dstFile, copyBufferSize)
+        return 'buffered'
+
+def link_file(srcPath, dstPath):
+    #returns False on a different volume or without hardlink support, caller copies instead
+    if platform.system() == 'Windows':
+        try:
+            win32file.CreateHardLink(dstPath, srcPath)
+        except win32api.error:
+            return False
+    else:
+        try:
+            os.link(srcPath, dstPath)
+        except OSError:
+            return False
+
+    return True
+
+def copy_files_parallel(copyList, numThreads):
+    if len(copyList) == 0:
+        return
+
+    copyQueue = Queue.Queue()
+    for copyItem in copyList:
+        copyQueue.put(copyItem)
+
+    resultsLock = threading.Lock()
+    methodCounts = {}
+    errors = []
+    totalBytes = [0]
+
+    def copy_worker():
+        while True:
+            try:
+                srcPath, dstPath, description = copyQueue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                sys.stdout.write('Writing ' + description + '\n') #single write so lines from different threads don't interleave
+                methodName = copy_file_contents(srcPath, dstPath)
+                with resultsLock:
+                    methodCounts[methodName] = methodCounts.get(methodName, 0) + 1
+                    totalBytes[0] += os.path.getsize(dstPath)
+            except (SystemExit, Exception), e:
+                with resultsLock:
+                    errors.append([dstPath, e])
+
+    startTime = time.time()
+    copyThreads = [threading.Thread(target=copy_worker) for i in xrange(min(numThreads, len(copyList)))]
+    for copyThread in copyThreads:
+        copyThread.start()
+    for copyThread in copyThreads:
+        copyThread.join()
+    elapsed = max(time.time() - startTime, 0.001)
+
+    if len(errors) > 0:
+        dstPath, e = errors[0]
+        sys.exit('Failed writing ' + dstPath + ': ' + str(e))
+
+    methodsStr = ', '.join([methodName + ': ' + str(methodCounts[methodName]) for methodName in sorted(methodCounts)])
+    print('Copied ' + str(len(copyList)) + ' files (' + str(totalBytes[0]) + ' bytes) in ' + ('%0.2f' % elapsed) + ' seconds, ' +
+          ('%0.1f' % (totalBytes[0] / elapsed / (1024*1024))) + ' MB/s (' + methodsStr + ')')
+
+class FileLock(object):
+    #held per open file, so it also keeps threads of the same process apart
+    def __init__(self, path):
+        self.path = path
+        self.lockFile = None
+
+    def acquire(self, blocking=True):
+        self.lockFile = open(self.path, 'a+b')
+        self.lockFile.seek(0)
+        while True:
+            try:
+                if platform.system() == 'Windows':
+                    msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                if not blocking:
+                    self.lockFile.close()
+                    self.lockFile = None
+                    return False
+                time.sleep(0.1)
+
+    def release(self):
+        if platform.system() == 'Windows':
+            self.lockFile.seek(0)
+            msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+        self.lockFile.close()
+        self.lockFile = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.release()
+
+def replace_file(srcPath, dstPath):
+    if platform.system() == 'Windows' and os.path.exists(dstPath):
+        os.remove(dstPath) #rename doesn't overwrite on Windows
+    os.rename(srcPath, dstPath)
+
+class DownloadCache(object):
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.indexPath = os.path.join(cacheDir, 'cache_index.json')
+
+    def updateIndex(self, updateFunc):
+        with FileLock(self.indexPath + '.lock'):
+            index = {}
+            if os.path.exists(self.indexPath):
+                try:
+                    with open(self.indexPath, 'rb') as indexFile:
+                        index = json.load(indexFile, object_hook=deunicodify_hook)
+                except ValueError:
+                    print('Download cache index ' + self.indexPath + ' is corrupted, starting a new one')
+
+            result = updateFunc(index)
+            tempIndexPath = self.indexPath + '.' + str(os.getpid()) + '.tmp'
+            with open(tempIndexPath, 'wb') as indexFile:
+                json.dump(index, indexFile, indent=4, sort_keys=True)
+            replace_file(tempIndexPath, self.indexPath)
+            return result
+
+    def cachedDigest(self, entryName, entryPath):
+        if not os.path.exists(entryPath):
+            return None
+
+        entryStat = os.stat(entryPath)
+        def lookup(index):
+            entry = index.get(entryName)
+            if (entry is not None) and (entry['size'] == entryStat.st_size) and (entry['mtime'] == entryStat.st_mtime):
+                entry['lastUsed'] = time.time()
+                return entry['sha256']
+            return None
+
+        digest = self.updateIndex(lookup)
+        if digest is None:
+            print('Needed archive already downloaded, checking hash...')
+            digest = get_sha256_file_digest(entryPath)
+            self.remember(entryName, entryPath, digest)
+
+        return digest
+
+    def remember(self, entryName, entryPath, digest):
+        entryStat = os.stat(entryPath)
+        def store(index):
+            index[entryName] = {'size': entryStat.st_size, 'mtime': entryStat.st_mtime, 'sha256': digest, 'lastUsed': time.time()}
+        self.updateIndex(store)
+
+    def evict(self, keepName):
+        if self.maxBytes <= 0:
+            return
+
+        def evictOldest(index):
+            indexName = os.path.basename(self.indexPath)
+            for entryName in os.listdir(self.cacheDir):
+                if (entryName in index) or entryName.startswith(indexName) or entryName.endswith(('.lock', '.part')):
+                    continue
+                entryPath = os.path.join(self.cacheDir, entryName)
+                if not os.path.isfile(entryPath):
+                    continue
+                #archives left by older versions or copied in by hand, hash them lazily on first use
+                entryStat = os.stat(entryPath)
+                index[entryName] = {'size': entryStat.st_size, 'mtime': entryStat.st_mtime, 'sha256': None, 'lastUsed': entryStat.st_mtime}
+
+            totalBytes = 0
+            for entryName in index.keys():
+                if os.path.exists(os.path.join(self.cacheDir, entryName)):
+                    totalBytes += index[entryName]['size']
+                else:
+                    del index[entryName]
+
+            for entryName in sorted(index.keys(), key=lambda name: index[name]['lastUsed']):
+                if totalBytes <= self.maxBytes:
+                    break
+                if entryName == keepName:
+                    continue
+
+                entryPath = os.path.join(self.cacheDir, entryName)
+                entryLock = FileLock(entryPath + '.lock')
+                if not entryLock.acquire(blocking=False):
+                    continue #somebody is downloading or linking it right now
+                try:
+                    print('Evicting ' + entryName + ' from download cache')
+                    os.remove(entryPath)
+                    totalBytes -= index[entryName]['size']
+                    del index[entryName]
+                finally:
+                    entryLock.release()
+
+        self.updateIndex(evictOldest)
+
+    def fetch(self, url, neededHash, workDir):
+        if not os.path.exists(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                if not os.path.isdir(self.cacheDir):
+                    raise
+
+        entryName = url.split("/")[-1]
+        entryPath = os.path.join(self.cacheDir, entryName)
+        workPath = os.path.join(workDir, entryName)
+        with FileLock(entryPath + '.lock'):
+            digest = self.cachedDigest(entryName, entryPath)
+            if digest is not None:
+                if digest[0:len(neededHash)].lower() != neededHash.lower():
+                    print('Existing file hash mismatch, deleting and redownloading')
+                    digest = None
+                else:
+                    print('Downloaded file hash is ' + digest[0:len(neededHash)] + ' as expected')
+
+            if digest is None:
+                partialPath = entryPath + '.part'
+                download_large_file(url, partialPath)
+                digest = get_sha256_file_digest(partialPath)
+                if digest[0:len(neededHash)].lower() != neededHash.lower():
+                    os.remove(partialPath)
+                    print('Downloaded file hash mismatch, exiting!')
+                    sys.exit('Downloaded file hash ' + digest[0:len(neededHash)] + ' expected ' + neededHash)
+                replace_file(partialPath, entryPath)
+                self.remember(entryName, entryPath, digest)
+
+            #our own link can't be evicted or replaced underneath us once the lock is gone
+            if not link_file(entryPath, workPath):
+                copy_file_contents(entryPath, workPath)
+
+        self.evict(entryName)
+        return workPath
+
+downloadCache = DownloadCache(cacheDir, cacheMaxBytes)
+
 def find_line_starting(strarray, prefix):
     for line in strarray:
         if line.startswith(prefix):
@@ -290,8 +944,10 @@ class NcaInfo(FileInfo):
         self.titleId = titleId
         self.contentType = contentType
 
-ncas = {}
-titles = {}
+sysVerTitleId = '0100000000000809'
+stdpkg2titles = ['0100000000000819', '010000000000081a']
+exfpkg2titles = ['010000000000081b', '010000000000081c']
+bogusExfatNcaId = '3b7cd379e18e2ee7e1c6d0449d540841' #bogus exFAT in 1.0.0
 
 class FirmwarePackage(object):
     titleId = ""
@@ -300,7 +956,7 @@ class FirmwarePackage(object):
     pkg1Bytes = []
     pkg2Bytes = []
 
-    def load(self, baseDir, subDir):
+    def load(self, ncas, baseDir, subDir):
         myDir = os.path.join(baseDir, self.titleId)
         os.makedirs(myDir)
         call_hactool(["-x", "--intype=nca", "--romfsdir="+myDir, ncas[self.ncaId].path])
@@ -459,91 +1115,139 @@ class KipHeader(object):
         return dstFile.contents
 
 
-print_welcome()
-upd_dir = inputFiles[-1]
-if not os.path.exists(upd_dir):
-    sys.exit('Input source firmware package path ' + upd_dir + " doesn't exist!")
+emmcBootPartitionSize = 0x400000
+emmcSectorSize = 0x200
+emmcCompareChunk = 0x10000
 
-if os.path.isdir(upd_dir):
-    print('Using source firmware files from folder ' + upd_dir)
-else:
-    updName, updExt = os.path.splitext(upd_dir)
-    if len(inFileType) == 0:
-        if updExt.lower() == '.xci':
-            inFileType = updExt.lower()[1:]
-        else:
-            with open(upd_dir, 'rb') as updFile:
-                magicBytes = updFile.read(4)
-                if (len(magicBytes) == 4) and (magicBytes == 'HFS0'):
-                    inFileType = 'hfs0'
+def read_gpt_partitions(imageFile, baseOffset):
+    imageFile.seek(baseOffset + emmcSectorSize)
+    headerBytes = imageFile.read(92)
+    if headerBytes[0:8] != 'EFI PART':
+        raise ValueError('No GPT header found at offset ' + hex(baseOffset + emmcSectorSize))
 
-            if len(inFileType) == 0:
-                sys.exit("Don't know the type of input file " + upd_dir + " please specify it with --intype parameter")
+    entriesLba, numEntries, entrySize = struct.unpack('<QII', headerBytes[72:88])
+    imageFile.seek(baseOffset + entriesLba*emmcSectorSize)
+    entriesBytes = imageFile.read(numEntries*entrySize)
 
-    targetFolder = updName + '_update'
-    print('Extracting files from ' + upd_dir + ' to folder ' + targetFolder)
+    partitions = {}
+    for i in xrange(numEntries):
+        entryBytes = entriesBytes[i*entrySize:(i+1)*entrySize]
+        if len(entryBytes) < 128:
+            break
+        firstLba, lastLba = struct.unpack('<QQ', entryBytes[32:48])
+        if lastLba < firstLba or firstLba == 0:
+            continue
+        partName = entryBytes[56:128].decode('utf-16-le').split(u'\0', 1)[0].encode('utf-8')
+        partitions[partName] = [baseOffset + firstLba*emmcSectorSize, (lastLba - firstLba + 1)*emmcSectorSize]
+
+    return partitions
+
+def find_emmc_targets(fullImagePath, boot0Path, boot1Path, rawnandPath):
+    targets = {}
+    gptImagePath = None
+    gptOffset = 0
+    if len(fullImagePath) > 0:
+        targets['BOOT0'] = [fullImagePath, 0, emmcBootPartitionSize]
+        targets['BOOT1'] = [fullImagePath, emmcBootPartitionSize, emmcBootPartitionSize]
+        gptImagePath = fullImagePath
+        gptOffset = 2*emmcBootPartitionSize
+    if len(boot0Path) > 0:
+        targets['BOOT0'] = [boot0Path, 0, os.path.getsize(boot0Path)]
+    if len(boot1Path) > 0:
+        targets['BOOT1'] = [boot1Path, 0, os.path.getsize(boot1Path)]
+    if len(rawnandPath) > 0:
+        gptImagePath = rawnandPath
+        gptOffset = 0
+
+    if gptImagePath is not None:
+        with open(gptImagePath, 'rb') as imageFile:
+            try:
+                partitions = read_gpt_partitions(imageFile, gptOffset)
+            except ValueError, e:
+                sys.exit('Unable to read partition table of ' + gptImagePath + ': ' + str(e))
+
+        for partName in ['BCPKG2-1-Normal-Main', 'BCPKG2-2-Normal-Sub', 'BCPKG2-3-SafeMode-Main', 'BCPKG2-4-SafeMode-Sub']:
+            if partName not in partitions:
+                sys.exit('Partition ' + partName + ' not found in ' + gptImagePath)
+            targets[partName] = [gptImagePath] + partitions[partName]
+
+    return targets
+
+def write_image_region(imageFile, offset, data):
+    #only rewrites the chunks whose contents differ, and hashes what is on disk afterwards
+    expectedHash = hashlib.sha256(data).digest()
+    hasher = hashlib.sha256()
+    bytesWritten = 0
+    for pos in xrange(0, len(data), emmcCompareChunk):
+        wantedBytes = bytes(data[pos:pos+emmcCompareChunk])
+        imageFile.seek(offset + pos)
+        diskBytes = imageFile.read(len(wantedBytes))
+        if diskBytes != wantedBytes:
+            imageFile.seek(offset + pos)
+            imageFile.write(wantedBytes)
+            imageFile.flush()
+            imageFile.seek(offset + pos)
+            diskBytes = imageFile.read(len(wantedBytes))
+            bytesWritten += len(wantedBytes)
+        hasher.update(diskBytes)
+
+    os.fsync(imageFile.fileno())
+    return [bytesWritten, hasher.digest() == expectedHash]
+
+def write_emmc_partitions(targets, partitionImages):
+    for partName, partBytes in partitionImages:
+        if partName not in targets:
+            continue
+
+        imagePath, partOffset, partSize = targets[partName]
+        if len(partBytes) > partSize:
+            sys.exit('Partition ' + partName + ' in ' + imagePath + ' is too small (' + hex(partSize) + ' bytes, need ' + hex(len(partBytes)) + ')')
+
+        with open(imagePath, 'r+b') as imageFile:
+            bytesWritten, verified = write_image_region(imageFile, partOffset, bytes(partBytes))
+        if not verified:
+            sys.exit('Verification of ' + partName + ' written to ' + imagePath + ' at offset ' + hex(partOffset) + ' failed!')
+        print('Wrote ' + partName + ' to ' + imagePath + ' at offset ' + hex(partOffset) + ' (' + str(bytesWritten) + ' bytes changed, verified)')
+
+def extract_firmware_package(srcPath, fileType, targetFolder=None, verbose=True):
+    updName, updExt = os.path.splitext(srcPath)
+    fileType = detect_package_type(srcPath, fileType)
+
+    if targetFolder is None:
+        targetFolder = updName + '_update'
+    if verbose:
+        print('Extracting files from ' + srcPath + ' to folder ' + targetFolder)
     if not os.path.exists(targetFolder):
         os.makedirs(targetFolder)
 
-    theargs = ['--intype='+inFileType]
-    if inFileType == 'nca':
+    theargs = ['--intype='+fileType]
+    if fileType == 'nca':
         theargs += ['--romfsdir='+targetFolder]
-    elif inFileType == 'xci':
+    elif fileType == 'xci':
         theargs += ['--updatedir='+targetFolder]
     else:
         theargs += ['--outdir='+targetFolder]
 
-    theargs += [upd_dir]
+    theargs += [srcPath]
     call_hactool(theargs)
-    upd_dir = targetFolder
-
-numMeta = 0
-numData = 0
-
-upd_dir_abs = os.path.abspath(upd_dir)
-for currDir, subdirs, files in os.walk(upd_dir_abs):
-    subdirs.sort()
-    files.sort()
-    for filename in files:
-        currFile = os.path.join(currDir, filename)
-        fileIsNca = False
-        if filename.endswith(".nca") or (filename == "00" and currDir.endswith(".nca")):
-            fileIsNca = True
-
-        if not fileIsNca:
-            print('file ' + currFile + ' not a NCA, skipping')
-            continue
-
-        ncaInfoLines = call_hactool(["-i", "--intype=nca", currFile]).splitlines()
-        ncaId = get_sha256_file_digest(currFile)
-        ncaId = ncaId[:len(ncaId)/2]
+    return targetFolder
 
-        titleId = find_line_starting(ncaInfoLines, "Title ID:")
-        contentType = find_line_starting(ncaInfoLines, "Content Type:")
+def is_nca_file(currDir, filename):
+    return filename.endswith(".nca") or (filename == "00" and currDir.endswith(".nca"))
 
-        if (titleId is None) or (contentType is None):
-            sys.exit(currFile + ' is missing Title ID or Content Type in hactool output!')
+def read_nca_title(ncaPath):
+    ncaInfoLines = call_hactool(["-i", "--intype=nca", ncaPath]).splitlines()
+    titleId = find_line_starting(ncaInfoLines, "Title ID:")
+    contentType = find_line_starting(ncaInfoLines, "Content Type:")
 
-        ncas[ncaId] = NcaInfo(currFile, '', titleId, contentType)
-        #print(ncaId + ' = NcaInfo(' + ncas[ncaId].path + ' , ' + ncas[ncaId].titleId + ' , ' + ncas[ncaId].contentType + ')')
-        if contentType == "Meta":
-            numMeta = numMeta + 1
-        else:
-            numData = numData + 1
-            if titleId not in titles:
-                titles[titleId] = ncaId
+    if (titleId is None) or (contentType is None):
+        sys.exit(ncaPath + ' is missing Title ID or Content Type in hactool output!')
 
-print('Found ' + str(numMeta) + ' meta and ' + str(numData) + ' data NCAs in ' + upd_dir_abs)
-sysVerNcaId = titles.get('0100000000000809')
-if sysVerNcaId is None:
-    sys.exit('System version NCA not found!')
+    return [titleId, contentType]
 
-tempDirName = ''
-try:
-    sysVerNcaPath = ncas[sysVerNcaId].path
-    tempDirName = tempfile.mkdtemp()
+def read_system_version(sysVerNcaPath, tempDirName):
     call_hactool(["-x", "--intype=nca", "--romfsdir="+tempDirName, sysVerNcaPath])
-    
+
     versionNumbers = [0,0,0,0]
     versionPlatform = ''
     versionHash = ''
@@ -561,21 +1265,267 @@ try:
     if not regenVersionStr.startswith(versionStr):
         sys.exit('Invalid system version in firmware!')
 
-    print("Package contains '" + versionPlatform + "' firmware version '" + versionStr + "' (" + regenVersionStr + ")" + " = " + versionDescr + "(hash : " + versionHash + ')')
-    
-    stdpkg2titles = ['0100000000000819', '010000000000081a']
-    exfpkg2titles = ['010000000000081b', '010000000000081c']
+    return [versionNumbers, versionPlatform, versionHash, versionStr, versionDescr]
+
+def scan_firmware_ncas(upd_dir_abs):
+    ncas = {}
+    titles = {}
+    numMeta = 0
+    numData = 0
+
+    for currDir, subdirs, files in os.walk(upd_dir_abs):
+        subdirs.sort()
+        files.sort()
+        for filename in files:
+            currFile = os.path.join(currDir, filename)
+            if not is_nca_file(currDir, filename):
+                print('file ' + currFile + ' not a NCA, skipping')
+                continue
+
+            titleId, contentType = read_nca_title(currFile)
+            ncaId = get_sha256_file_digest(currFile)
+            ncaId = ncaId[:len(ncaId)/2]
+
+            ncas[ncaId] = NcaInfo(currFile, '', titleId, contentType)
+            #print(ncaId + ' = NcaInfo(' + ncas[ncaId].path + ' , ' + ncas[ncaId].titleId + ' , ' + ncas[ncaId].contentType + ')')
+            if contentType == "Meta":
+                numMeta = numMeta + 1
+            else:
+                numData = numData + 1
+                if titleId not in titles:
+                    titles[titleId] = ncaId
+
+    print('Found ' + str(numMeta) + ' meta and ' + str(numData) + ' data NCAs in ' + upd_dir_abs)
+    return ncas, titles
 
+def detect_package_type(srcPath, fileType):
+    if len(fileType) == 0:
+        if os.path.splitext(srcPath)[1].lower() == '.xci':
+            fileType = 'xci'
+        else:
+            with open(srcPath, 'rb') as updFile:
+                magicBytes = updFile.read(4)
+                if (len(magicBytes) == 4) and (magicBytes == 'HFS0'):
+                    fileType = 'hfs0'
+
+            if len(fileType) == 0:
+                sys.exit("Don't know the type of input file " + srcPath + " please specify it with --intype parameter")
+
+    return fileType
+
+def read_hfs0_entries(srcFile, hfs0Offset):
+    srcFile.seek(hfs0Offset)
+    headerBytes = srcFile.read(0x10)
+    if (len(headerBytes) != 0x10) or (headerBytes[0:4] != 'HFS0'):
+        raise ValueError('No HFS0 header at offset ' + hex(hfs0Offset))
+
+    numFiles, stringTableSize = struct.unpack('<II', headerBytes[4:12])
+    entriesBytes = srcFile.read(numFiles*0x40)
+    stringTable = srcFile.read(stringTableSize)
+    dataOffset = hfs0Offset + 0x10 + numFiles*0x40 + stringTableSize
+
+    entries = {}
+    for i in xrange(numFiles):
+        fileOffset, fileSize, nameOffset = struct.unpack('<QQI', entriesBytes[i*0x40:i*0x40+20])
+        entries[stringTable[nameOffset:].split('\0', 1)[0]] = [dataOffset + fileOffset, fileSize]
+
+    return entries
+
+def read_update_partition(srcPath, fileType):
+    with open(srcPath, 'rb') as srcFile:
+        if fileType == 'hfs0':
+            return read_hfs0_entries(srcFile, 0)
+
+        srcFile.seek(0x100)
+        if srcFile.read(4) != 'HEAD':
+            raise ValueError('Invalid XCI header')
+        srcFile.seek(0x130)
+        rootOffset = struct.unpack('<Q', srcFile.read(8))[0]
+        rootEntries = read_hfs0_entries(srcFile, rootOffset)
+        if 'update' not in rootEntries:
+            raise ValueError('XCI has no update partition')
+        return read_hfs0_entries(srcFile, rootEntries['update'][0])
+
+def extract_hfs0_file(srcPath, fileOffset, fileSize, dstPath):
+    with open(srcPath, 'rb') as srcFile, open(dstPath, 'wb') as dstFile:
+        srcFile.seek(fileOffset)
+        remaining = fileSize
+        while remaining > 0:
+            block = srcFile.read(min(remaining, copyBufferSize))
+            if not block:
+                raise IOError('Unexpected end of ' + srcPath)
+            dstFile.write(block)
+            remaining -= len(block)
+
+    return dstPath
+
+bootImagePackageMaxSize = 32*1024*1024
+identifyExfatSearchLimit = 32
+
+def identify_firmware(srcPath, srcType):
+    if not os.path.exists(srcPath):
+        sys.exit('Input source firmware package path ' + srcPath + " doesn't exist!")
+
+    tempDirName = tempfile.mkdtemp()
+    try:
+        #SystemVersion is one of the smallest NCAs, so looking at the small ones first finds it quickly
+        candidates = []
+        fileType = ''
+        if not os.path.isdir(srcPath):
+            fileType = detect_package_type(srcPath, srcType)
+
+        if fileType in ['xci', 'hfs0']:
+            #only the NCAs we look at get copied out, instead of extracting the whole partition
+            try:
+                updateEntries = read_update_partition(srcPath, fileType)
+            except (ValueError, struct.error), e:
+                sys.exit('Unable to read ' + srcPath + ': ' + str(e))
+            for entryName in updateEntries:
+                if entryName.endswith('.nca') and not entryName.endswith('.cnmt.nca'):
+                    entryOffset, entrySize = updateEntries[entryName]
+                    candidates += [[entrySize, entryName, entryOffset]]
+        else:
+            upd_dir = srcPath
+            if fileType != '':
+                upd_dir = extract_firmware_package(srcPath, fileType, os.path.join(tempDirName, 'update'), verbose=False)
+            for currDir, subdirs, files in os.walk(os.path.abspath(upd_dir)):
+                for filename in files:
+                    if is_nca_file(currDir, filename) and not filename.endswith('.cnmt.nca'):
+                        currFile = os.path.join(currDir, filename)
+                        candidates += [[os.path.getsize(currFile), currFile, None]]
+        candidates.sort()
+
+        sysVerNcaPath = None
+        exfatNcaPath = None
+        exfatDecided = False
+        maxBipSize = bootImagePackageMaxSize
+        searchesLeft = identifyExfatSearchLimit
+        for ncaSize, ncaName, ncaOffset in candidates:
+            if sysVerNcaPath is not None:
+                if ncaSize > maxBipSize:
+                    exfatDecided = True #no BootImagePackage is this large, so none of the rest is the exFAT one
+                    break
+                if searchesLeft == 0:
+                    break
+                searchesLeft -= 1
+
+            ncaPath = ncaName
+            if ncaOffset is not None:
+                ncaPath = extract_hfs0_file(srcPath, ncaOffset, ncaSize, os.path.join(tempDirName, ncaName))
+
+            titleId, contentType = read_nca_title(ncaPath)
+            if contentType != "Meta":
+                if (titleId == sysVerTitleId) and (sysVerNcaPath is None):
+                    sysVerNcaPath = ncaPath
+                elif (titleId == exfpkg2titles[0]) and (exfatNcaPath is None):
+                    exfatNcaPath = ncaPath
+                elif titleId == stdpkg2titles[0]:
+                    #the exFAT package only differs from the normal one in its FS, so it is about as big
+                    maxBipSize = min(maxBipSize, ncaSize*2)
+
+            if (ncaOffset is not None) and (ncaPath not in [sysVerNcaPath, exfatNcaPath]):
+                os.remove(ncaPath)
+
+            if (sysVerNcaPath is not None) and (exfatNcaPath is not None):
+                break
+        else:
+            exfatDecided = True
+
+        if sysVerNcaPath is None:
+            sys.exit('System version NCA not found!')
+
+        versionNumbers, versionPlatform, versionHash, versionStr, versionDescr = read_system_version(sysVerNcaPath, os.path.join(tempDirName, 'sysver'))
+        hasExfat = None
+        if exfatNcaPath is not None:
+            exfatNcaId = get_sha256_file_digest(exfatNcaPath)
+            hasExfat = exfatNcaId[:len(exfatNcaId)/2].lower() != bogusExfatNcaId
+        elif exfatDecided:
+            hasExfat = False
+
+        return {'source': srcPath, 'versionNumbers': list(versionNumbers), 'platform': versionPlatform, 'version': versionStr,
+                'versionHash': versionHash, 'description': versionDescr, 'exfat': hasExfat}
+    finally:
+        shutil.rmtree(tempDirName, ignore_errors=True)
+
+manifestName = 'manifest.json'
+deltaName = 'delta.json'
+
+def manifest_path(relPath):
+    return relPath.replace('\\', '/')
+
+def hashes_match(hashA, hashB):
+    #index hashes are truncated sha256 digests of varying length
+    hashLen = min(len(hashA), len(hashB))
+    return (hashLen > 0) and (hashA[:hashLen].lower() == hashB[:hashLen].lower())
+
+def load_delta_base(basePath):
+    if os.path.isdir(basePath) and os.path.exists(os.path.join(basePath, manifestName)):
+        basePath = os.path.join(basePath, manifestName)
+
+    if not os.path.isdir(basePath):
+        try:
+            with open(basePath, 'rb') as manifestFile:
+                return json.load(manifestFile, object_hook=deunicodify_hook)
+        except ValueError:
+            sys.exit('Delta base manifest ' + basePath + ' is not valid JSON!')
+
+    print('No ' + manifestName + ' in ' + basePath + ', hashing its files instead')
+    baseFiles = {}
+    for currDir, subdirs, files in os.walk(basePath):
+        for filename in files:
+            filePath = os.path.join(currDir, filename)
+            relPath = manifest_path(os.path.relpath(filePath, basePath))
+            if relPath not in [manifestName, deltaName]:
+                baseFiles[relPath] = {'hash': get_sha256_file_digest(filePath), 'type': 'file'}
+
+    baseName = os.path.basename(os.path.normpath(basePath)).split('_from_')[0] #a delta folder is named after its firmware set plus its base
+    return {'name': baseName, 'files': baseFiles}
+
+def unchanged_in_base(relPath, fileHash):
+    if deltaBase is None:
+        return False
+
+    baseEntry = deltaBase['files'].get(manifest_path(relPath))
+    return (baseEntry is not None) and hashes_match(baseEntry['hash'], fileHash)
+
+def write_manifests(outDir, firmwareSetName, versionInfo, firmwareIsExFAT, manifestFiles, manifestDirs, manifestEmmc):
+    versionNumbers, versionPlatform, versionHash, versionStr, versionDescr = versionInfo
+    manifest = {'name': firmwareSetName, 'platform': versionPlatform, 'version': versionStr, 'versionHash': versionHash,
+                'exfat': firmwareIsExFAT, 'files': manifestFiles, 'dirs': manifestDirs}
+    if len(manifestEmmc) > 0:
+        manifest['emmc'] = manifestEmmc
+    with open(os.path.join(outDir, manifestName), 'wb') as manifestFile:
+        json.dump(manifest, manifestFile, indent=4, sort_keys=True)
+
+    if deltaBase is None:
+        return
+
+    added = []
+    changed = []
+    for relPath in sorted(manifestFiles):
+        baseEntry = deltaBase['files'].get(relPath)
+        if baseEntry is None:
+            added += [relPath]
+        elif not hashes_match(baseEntry['hash'], manifestFiles[relPath]['hash']):
+            changed += [relPath]
+    removed = [relPath for relPath in sorted(deltaBase['files']) if relPath not in manifestFiles]
+
+    delta = {'base': deltaBase['name'], 'target': firmwareSetName, 'added': added, 'changed': changed, 'removed': removed}
+    with open(os.path.join(outDir, deltaName), 'wb') as deltaFile:
+        json.dump(delta, deltaFile, indent=4, sort_keys=True)
+    print('Delta from ' + deltaBase['name'] + ': ' + str(len(added)) + ' added, ' + str(len(changed)) + ' changed, ' + str(len(removed)) + ' removed files')
+
+def select_firmware_packages(titles, wantExfat):
     normalPkg = FirmwarePackage()
     safePkg = FirmwarePackage()
 
-    if try_exfat:
+    if wantExfat:
         normalPkg.titleId = exfpkg2titles[0]
         normalPkg.ncaId = titles.get(normalPkg.titleId)
         safePkg.titleId = exfpkg2titles[1]
         safePkg.ncaId = titles.get(safePkg.titleId)
 
-    if (normalPkg.ncaId is not None) and (normalPkg.ncaId.lower() == '3b7cd379e18e2ee7e1c6d0449d540841'): #bogus exFAT in 1.0.0
+    if (normalPkg.ncaId is not None) and (normalPkg.ncaId.lower() == bogusExfatNcaId):
         normalPkg.ncaId = None
 
     if normalPkg.ncaId is None:
@@ -590,11 +1540,15 @@ try:
     if safePkg.ncaId is None:
         sys.exit('Missing SAFE Firmware Package! (TitleID: ' + safePkg.titleId + ')')
 
+    return [normalPkg, safePkg]
+
+def build_firmware_variant(ncas, normalPkg, safePkg, versionInfo, outBaseDir, tempDirName, linkSources):
+    versionNumbers, versionPlatform, versionHash, versionStr, versionDescr = versionInfo
     firmwareIsExFAT = normalPkg.titleId in exfpkg2titles
     print('Using TitleID ' + normalPkg.titleId + ' for Normal firmware package')
-    pkg2path = normalPkg.load(tempDirName, versionPlatform.lower())
+    pkg2path = normalPkg.load(ncas, tempDirName, versionPlatform.lower())
     print('Using TitleID ' + safePkg.titleId + ' for SAFE firmware package')
-    safePkg.load(tempDirName, versionPlatform.lower())
+    safePkg.load(ncas, tempDirName, versionPlatform.lower())
 
     boot0 = bytearray()
     boot0 += normalPkg.bctBytes
@@ -627,24 +1581,24 @@ try:
 
     pkg2_4 = pkg2_3
 
-    prevDir = os.getcwdu()
     call_hactool(["-x", "--intype=package2", "--outdir="+tempDirName, pkg2path])
     call_hactool(["-x", "--intype=ini1", "--outdir="+tempDirName, os.path.join(tempDirName,"INI1.bin")])
-    os.chdir(tempDirName)
-    compFSkipName = "FS.kip1"    
-    compFSKipHash = get_sha256_file_digest(compFSkipName)
+    compFSkipName = "FS.kip1"
+    compFSKipHash = get_sha256_file_digest(os.path.join(tempDirName, compFSkipName))
     compFSKipHash = compFSKipHash[:len(compFSKipHash)/2].lower()
 
     print('Decompressing ' + compFSkipName + ' from TitleID ' + normalPkg.titleId + ' hash ' + compFSKipHash)
     kipdata = KipHeader()
-    with open(compFSkipName, 'rb') as srcKipFile:        
-        kipdata.load(srcKipFile)    
+    with open(os.path.join(tempDirName, compFSkipName), 'rb') as srcKipFile:
+        kipdata.load(srcKipFile)
     kipdata.decompress()
     kipdata = kipdata.getContents()
-    
-    fsPatches = {}
-    fsPatchesJsonBytes = fetch_url_bytes('https://switchtools.sshnuke.net/firmware/fs_patches.json')
-    fsPatches = json.loads(fsPatchesJsonBytes, object_hook=deunicodify_hook)
+
+    patchesRequestedAt = time.time()
+    fsPatches = get_fs_patches()
+    if compFSKipHash not in fsPatches['versions']:
+        #the server might have gained support since the cached copy was fetched
+        fsPatches = get_fs_patches(notBefore=patchesRequestedAt)
 
     fsVersions = fsPatches['versions']
     if compFSKipHash not in fsVersions:
@@ -679,34 +1633,37 @@ try:
             sourceBytes = bytes(kipdata[offsetNum:offsetNum+len(targetBytes)])
             if sourceBytes != targetBytes:
                 sys.exit("Data at offset " + hex(offsetNum) + ' ( ' + binascii.hexlify(sourceBytes) + ' ) does not match expected ( ' + binascii.hexlify(targetBytes) + ' )!')
-            
+
             print('Written to ' + hex(offsetNum) + ': ' + binascii.hexlify(sourceBytes).upper())
 
         finalFilenameArr += [wntpatch]
 
-    
+
     fsPatchTarget = '_'.join(finalFilenameArr) + os.path.splitext(fsVersionName)[1]
-    with open(fsPatchTarget, 'wb') as dstPatchedFile:
+    fsPatchTargetPath = os.path.join(tempDirName, fsPatchTarget)
+    with open(fsPatchTargetPath, 'wb') as dstPatchedFile:
         dstPatchedFile.write(kipdata)
 
-    fsPatchedSize = os.stat(fsPatchTarget).st_size
+    fsPatchedSize = os.stat(fsPatchTargetPath).st_size
     print('Compressing ' + fsPatchTarget + '...')
-    realtime_run([kip1decomp, "c", fsPatchTarget, fsPatchTarget])
-    print('Compressed ' + fsPatchTarget + ' from ' + str(fsPatchedSize) + ' to ' + str(os.stat(fsPatchTarget).st_size) + ' bytes')
-    os.chdir(prevDir)
+    realtime_run([kip1decomp, "c", fsPatchTargetPath, fsPatchTargetPath])
+    print('Compressed ' + fsPatchTarget + ' from ' + str(fsPatchedSize) + ' to ' + str(os.stat(fsPatchTargetPath).st_size) + ' bytes')
 
-    outDirName = versionPlatform + '-' + versionStr
+    firmwareSetName = versionPlatform + '-' + versionStr
     if firmwareIsExFAT:
-        outDirName += '_exfat'
+        firmwareSetName += '_exfat'
+    outDirName = firmwareSetName
+    if deltaBase is not None:
+        outDirName += '_from_' + deltaBase['name']
 
-    shutil.rmtree(outDirName, ignore_errors=True)
-    os.makedirs(outDirName)
-    os.chdir(outDirName)
+    outDir = os.path.join(outBaseDir, outDirName)
+    shutil.rmtree(outDir, ignore_errors=True)
+    os.makedirs(outDir)
 
     print('Writing microSD files')
-    microsdDir = "microSD"
+    microsdDir = os.path.join(outDir, "microSD")
     os.mkdir(microsdDir)
-    shutil.move(os.path.join(tempDirName, fsPatchTarget), os.path.join(microsdDir, fsPatchTarget))
+    shutil.move(fsPatchTargetPath, os.path.join(microsdDir, fsPatchTarget))
     with open(os.path.join(microsdDir, 'hekate_ipl.ini'),'w') as hekateFile:
         stockSectionName = 'stock'
         fsSectionName = 'FS_' + versionStr.replace(".","")
@@ -722,19 +1679,18 @@ try:
         hekateFile.write("kip1=" + fsPatchTarget + "\n")
         hekateFile.write("\n")
 
+    manifestFiles = {}
+    for microsdFile in [fsPatchTarget, 'hekate_ipl.ini']:
+        manifestFiles['microSD/' + microsdFile] = {'hash': get_sha256_file_digest(os.path.join(microsdDir, microsdFile)), 'type': 'microSD'}
+
     jayson = {}
     try:
-        patchesJsonUrl = 'https://switchtools.sshnuke.net/firmware/'+versionHash
-        if firmwareIsExFAT:
-            patchesJsonUrl += '_exfat'
-        patchesJsonUrl += '.json'
-
-        jayson = json.loads(fetch_url_bytes(patchesJsonUrl), object_hook=deunicodify_hook)
-    except urllib2.HTTPError, e:
+        jayson = get_firmware_index(versionHash, firmwareIsExFAT)
+    except HttpError, e:
         if e.code != 404:
             raise
         else:
-            sys.exit('No index on server for ' + outDirName + '. This firmware is not supported(yet?)')
+            sys.exit('No index on server for ' + firmwareSetName + '. This firmware is not supported(yet?)')
 
     for ncaId in jayson['ncas']:
         ncaDict = jayson['ncas'][ncaId]
@@ -761,42 +1717,21 @@ try:
     archivedFilesPath = ''
     archiveInfo = jayson.get('archive')
     if archiveInfo is not None:
-        downloadsFolder = os.path.join(tempfile.gettempdir(), programName)
-        if not os.path.exists(downloadsFolder):
-            os.mkdir(downloadsFolder)
-
-        archivedFilesPath = os.path.join(downloadsFolder, archiveInfo['url'].split("/")[-1])
-        needsDownload = True
-        neededHash = archiveInfo['hash']
-        if os.path.exists(archivedFilesPath):
-            print('Needed archive already downloaded, checking hash...')
-            archiveHash = get_sha256_file_digest(archivedFilesPath)[0:len(neededHash)]
-            if archiveHash.lower() != neededHash.lower():
-                print('Existing file hash mismatch, deleting and redownloading')
-            else:
-                print('Downloaded file hash is ' + archiveHash + ' as expected')
-                needsDownload = False
-
-        if needsDownload:
-            download_large_file(archiveInfo['url'], archivedFilesPath)
-            archiveHash = get_sha256_file_digest(archivedFilesPath)[0:len(neededHash)]
-            if archiveHash.lower() != neededHash.lower():
-                print('Downloaded file hash mismatch, exiting!')
-                sys.exit('Downloaded file hash ' + archiveHash + ' expected ' + neededHash)
+        archivedFilesPath = downloadCache.fetch(archiveInfo['url'], archiveInfo['hash'], tempDirName)
 
+    partitionImages = [['BOOT0', boot0], ['BOOT1', boot1], ['BCPKG2-1-Normal-Main', pkg2_1], ['BCPKG2-2-Normal-Sub', pkg2_2], ['BCPKG2-3-SafeMode-Main', pkg2_3], ['BCPKG2-4-SafeMode-Sub', pkg2_4]]
     print('Writing partition images')
-    with open('BOOT0.bin','wb') as boot0file:
-        boot0file.write(boot0)
-    with open('BOOT1.bin','wb') as boot1file:
-        boot1file.write(boot1)
-    with open('BCPKG2-1-Normal-Main.bin','wb') as bcpkg2_1file:
-        bcpkg2_1file.write(pkg2_1)
-    with open('BCPKG2-2-Normal-Sub.bin','wb') as bcpkg2_2file:
-        bcpkg2_2file.write(pkg2_2)
-    with open('BCPKG2-3-SafeMode-Main.bin','wb') as bcpkg2_3file:
-        bcpkg2_3file.write(pkg2_3)
-    with open('BCPKG2-4-SafeMode-Sub.bin','wb') as bcpkg2_4file:
-        bcpkg2_4file.write(pkg2_4)
+    manifestEmmc = {}
+    for partName, partBytes in partitionImages:
+        partHash = hashlib.sha256(bytes(partBytes)).hexdigest()
+        if partName in emmcTargets:
+            #goes straight into the eMMC image once everything else is verified, so there is no .bin file to list
+            imagePath, partOffset, partSize = emmcTargets[partName]
+            manifestEmmc[partName] = {'image': os.path.abspath(imagePath), 'offset': partOffset, 'hash': partHash}
+            continue
+        manifestFiles[partName + '.bin'] = {'hash': partHash, 'type': 'partition'}
+        with open(os.path.join(outDir, partName + '.bin'),'wb') as partFile:
+            partFile.write(partBytes)
 
     dirsToMake = []
     for dirPath in jayson['dirs']:
@@ -804,30 +1739,305 @@ try:
 
     for dirPath in sorted(dirsToMake):
         #print('Making dir ' + dirPath)
-        os.makedirs(dirPath)
-        set_file_attributes(dirPath, jayson['dirs'][dirPath])
+        os.makedirs(os.path.join(outDir, dirPath))
+        set_file_attributes(os.path.join(outDir, dirPath), jayson['dirs'][dirPath])
 
+    ncaCopies = []
+    numLinked = 0
+    numUnchanged = 0
     for ncaId in jayson['ncas']:
         srcInfo = ncas[ncaId]
         targetInfo = jayson['ncas'][ncaId]
-        print('Writing NCA ' + targetInfo.contentType + ':' + targetInfo.titleId + ' to ' + targetInfo.path)
-        shutil.copyfile(srcInfo.path, targetInfo.path)
-        set_file_attributes(targetInfo.path, targetInfo.attrs)
+        targetPath = os.path.join(outDir, targetInfo.path)
+        manifestFiles[manifest_path(targetInfo.path)] = {'hash': ncaId, 'type': 'nca'}
+        if unchanged_in_base(targetInfo.path, ncaId):
+            numUnchanged += 1
+            continue
+        if (ncaId in linkSources) and link_file(linkSources[ncaId], targetPath):
+            numLinked += 1
+            continue
+        ncaCopies += [[srcInfo.path, targetPath, 'NCA ' + targetInfo.contentType + ':' + targetInfo.titleId + ' to ' + targetInfo.path]]
+
+    if numLinked > 0:
+        print('Linked ' + str(numLinked) + ' NCAs already written for the other firmware set')
+    if numUnchanged > 0:
+        print('Skipped ' + str(numUnchanged) + ' NCAs unchanged since ' + deltaBase['name'])
+    copy_files_parallel(ncaCopies, numCopyThreads)
+    for ncaId in jayson['ncas']:
+        targetInfo = jayson['ncas'][ncaId]
+        targetPath = os.path.join(outDir, targetInfo.path)
+        if not os.path.exists(targetPath):
+            continue
+        set_file_attributes(targetPath, targetInfo.attrs)
+        linkSources[ncaId] = os.path.abspath(targetPath)
 
     if archivedFilesPath != '':
-        realtime_run([seven7a, "x", archivedFilesPath, "-aoa"])
+        realtime_run([seven7a, "x", archivedFilesPath, "-aoa", "-o" + outDir])
 
     for fileHash in jayson['files']:
         fileInfo = jayson['files'][fileHash]
-        filePath = fileInfo.path
-        print('Verifying file ' + filePath)
+        filePath = os.path.join(outDir, fileInfo.path)
+        print('Verifying file ' + fileInfo.path)
         fileNewHash = get_sha256_file_digest(filePath)[0:len(fileHash)]
         if fileNewHash.lower() != fileHash.lower():
             print('Invalid hash, cannot continue!')
-            sys.exit('Extracted file ' + filePath + ' has hash ' + fileNewHash + ' , expected ' + fileHash)
-        set_file_attributes(filePath, fileInfo.attrs)
+            sys.exit('Extracted file ' + fileInfo.path + ' has hash ' + fileNewHash + ' , expected ' + fileHash)
+
+        manifestFiles[manifest_path(fileInfo.path)] = {'hash': fileHash, 'type': 'file'}
+        if unchanged_in_base(fileInfo.path, fileHash):
+            os.remove(filePath) #the target already has it, delta only carries what changed
+        else:
+            set_file_attributes(filePath, fileInfo.attrs)
+
+    if len(emmcTargets) > 0:
+        print('Writing partition images into eMMC image')
+        write_emmc_partitions(emmcTargets, partitionImages)
+
+    write_manifests(outDir, firmwareSetName, versionInfo, firmwareIsExFAT, manifestFiles, jayson['dirs'], manifestEmmc)
+    print('All files verified! Prepared firmware update is in folder ' + os.path.abspath(outDir))
+    return outDir
+
+def convert_firmware(srcPath, srcType, outBaseDir, extractDir=None):
+    upd_dir = srcPath
+    if not os.path.exists(upd_dir):
+        sys.exit('Input source firmware package path ' + upd_dir + " doesn't exist!")
+
+    if os.path.isdir(upd_dir):
+        print('Using source firmware files from folder ' + upd_dir)
+    else:
+        upd_dir = extract_firmware_package(upd_dir, srcType, extractDir)
+
+    upd_dir_abs = os.path.abspath(upd_dir)
+    ncas, titles = scan_firmware_ncas(upd_dir_abs)
+    sysVerNcaId = titles.get(sysVerTitleId)
+    if sysVerNcaId is None:
+        sys.exit('System version NCA not found!')
+
+    tempDirName = ''
+    try:
+        sysVerNcaPath = ncas[sysVerNcaId].path
+        tempDirName = tempfile.mkdtemp()
+        versionNumbers, versionPlatform, versionHash, versionStr, versionDescr = read_system_version(sysVerNcaPath, tempDirName)
+
+        regenVersionStr = str(versionNumbers[0]) + "." + str(versionNumbers[1]) + "." + str(versionNumbers[2]) + "." + str(versionNumbers[3])
+        print("Package contains '" + versionPlatform + "' firmware version '" + versionStr + "' (" + regenVersionStr + ")" + " = " + versionDescr + "(hash : " + versionHash + ')')
+
+        versionInfo = [versionNumbers, versionPlatform, versionHash, versionStr, versionDescr]
+        variants = [False, True] if build_both else [try_exfat]
+        outDirs = []
+        linkSources = {}
+        for wantExfat in variants:
+            normalPkg, safePkg = select_firmware_packages(titles, wantExfat)
+            if (len(variants) > 1) and wantExfat and (normalPkg.titleId not in exfpkg2titles):
+                print('Firmware has no exFAT firmware package, only the normal set was made')
+                continue
 
-    print('All files verified! Prepared firmware update is in folder ' + os.getcwd())
-finally:
-    if tempDirName != '':
-        shutil.rmtree(tempDirName, ignore_errors=True)
\ No newline at end of file
+            variantTempDir = os.path.join(tempDirName, 'exfat' if wantExfat else 'normal')
+            os.makedirs(variantTempDir)
+            outDirs += [build_firmware_variant(ncas, normalPkg, safePkg, versionInfo, outBaseDir, variantTempDir, linkSources)]
+
+        return outDirs
+    finally:
+        if tempDirName != '':
+            shutil.rmtree(tempDirName, ignore_errors=True)
+
+watchExtensions = ['.xci', '.hfs0', '.nca']
+watchSettleSeconds = 5
+watchPollSeconds = 2
+
+def get_watch_signature(entryPath):
+    if not os.path.isdir(entryPath):
+        entryStat = os.stat(entryPath)
+        return [entryStat.st_size, entryStat.st_mtime]
+
+    numFiles = 0
+    totalSize = 0
+    newestTime = os.stat(entryPath).st_mtime
+    for currDir, subdirs, files in os.walk(entryPath):
+        for filename in files:
+            fileStat = os.stat(os.path.join(currDir, filename))
+            numFiles += 1
+            totalSize += fileStat.st_size
+            newestTime = max(newestTime, fileStat.st_mtime)
+
+    return [numFiles, totalSize, newestTime]
+
+class WatchJob(object):
+    name = ""
+    srcPath = ""
+    srcType = ""
+    signature = []
+    status = "queued"
+    error = ""
+    outDirs = []
+    queuedAt = 0
+    startedAt = 0
+    seconds = 0
+
+    def __init__(self, name, srcPath, srcType, signature):
+        self.name = name
+        self.srcPath = srcPath
+        self.srcType = srcType
+        self.signature = signature
+        self.queuedAt = time.time()
+
+    def toDict(self):
+        return {'name': self.name, 'source': self.srcPath, 'signature': self.signature, 'status': self.status,
+                'error': self.error, 'output': self.outDirs, 'queuedAt': self.queuedAt, 'startedAt': self.startedAt, 'seconds': self.seconds}
+
+class FolderWatcher(object):
+    def __init__(self, watchDir, outBaseDir, numWorkers):
+        self.watchDir = os.path.abspath(watchDir)
+        self.outBaseDir = os.path.abspath(outBaseDir)
+        self.statusPath = os.path.join(self.watchDir, programName + '_status.json')
+        self.numWorkers = numWorkers
+        self.jobQueue = Queue.Queue()
+        self.statusLock = threading.Lock()
+        self.activeJobs = []
+        self.finishedJobs = collections.deque(maxlen=1000)
+        self.knownSignatures = {}
+        self.pendingSignatures = {}
+
+        #don't redo jobs that a previous daemon run already finished
+        if os.path.exists(self.statusPath):
+            try:
+                with open(self.statusPath, 'rb') as statusFile:
+                    prevStatus = json.load(statusFile, object_hook=deunicodify_hook)
+                for jobDict in prevStatus.get('finished', []):
+                    if jobDict['status'] == 'done':
+                        self.knownSignatures[jobDict['source']] = jobDict['signature']
+            except (ValueError, KeyError):
+                print('Ignoring unreadable status file ' + self.statusPath)
+
+    def scan(self):
+        now = time.time()
+        for entryName in sorted(os.listdir(self.watchDir)):
+            entryPath = os.path.join(self.watchDir, entryName)
+            if entryName.startswith('.') or (entryPath == self.statusPath) or (entryPath == self.outBaseDir):
+                continue
+
+            entryType = ''
+            if not os.path.isdir(entryPath):
+                entryType = os.path.splitext(entryName)[1].lower()
+                if entryType not in watchExtensions:
+                    continue
+                entryType = entryType[1:]
+
+            try:
+                signature = get_watch_signature(entryPath)
+            except OSError:
+                continue #removed or renamed while we were looking at it
+
+            if self.knownSignatures.get(entryPath) == signature:
+                continue
+
+            #only pick up entries that stopped changing, the writer might still be copying them
+            pending = self.pendingSignatures.get(entryPath)
+            if (pending is None) or (pending[0] != signature):
+                self.pendingSignatures[entryPath] = [signature, now]
+                continue
+            if now - pending[1] < watchSettleSeconds:
+                continue
+
+            del self.pendingSignatures[entryPath]
+            self.knownSignatures[entryPath] = signature
+            print('Queueing ' + entryPath + ' for conversion')
+            self.jobQueue.put(WatchJob(entryName, entryPath, entryType, signature))
+
+    def writeStatus(self):
+        with self.statusLock:
+            status = {'queueDepth': self.jobQueue.qsize(), 'workers': self.numWorkers, 'updatedAt': time.time(),
+                      'active': [job.toDict() for job in self.activeJobs],
+                      'finished': [job.toDict() for job in self.finishedJobs]}
+
+            tempStatusPath = self.statusPath + '.tmp'
+            with open(tempStatusPath, 'wb') as statusFile:
+                json.dump(status, statusFile, indent=4, sort_keys=True)
+            if platform.system() == 'Windows' and os.path.exists(self.statusPath):
+                os.remove(self.statusPath)
+            os.rename(tempStatusPath, self.statusPath)
+
+    def runJob(self, job):
+        jobTempDir = tempfile.mkdtemp(prefix=programName + '_')
+        try:
+            jobOutDir = os.path.join(self.outBaseDir, job.name)
+            job.outDirs = convert_firmware(job.srcPath, job.srcType, jobOutDir, os.path.join(jobTempDir, 'update'))
+            job.status = 'done'
+        except SystemExit, e:
+            job.status = 'failed'
+            job.error = str(e.code)
+        except Exception, e:
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            shutil.rmtree(jobTempDir, ignore_errors=True)
+
+    def workerLoop(self):
+        while True:
+            job = self.jobQueue.get()
+            with self.statusLock:
+                job.status = 'running'
+                job.startedAt = time.time()
+                self.activeJobs.append(job)
+            self.writeStatus()
+
+            self.runJob(job)
+
+            with self.statusLock:
+                job.seconds = time.time() - job.startedAt
+                self.activeJobs.remove(job)
+                self.finishedJobs.append(job)
+            print('Job ' + job.name + ' ' + job.status + ' after ' + ('%0.1f' % job.seconds) + ' seconds ' + job.error)
+            self.writeStatus()
+            self.jobQueue.task_done()
+
+    def run(self):
+        if not os.path.isdir(self.watchDir):
+            sys.exit('Watch folder ' + self.watchDir + " doesn't exist!")
+        if not os.path.exists(self.outBaseDir):
+            os.makedirs(self.outBaseDir)
+
+        for i in xrange(self.numWorkers):
+            workerThread = threading.Thread(target=self.workerLoop, name='worker-' + str(i))
+            workerThread.daemon = True
+            workerThread.start()
+
+        print('Watching folder ' + self.watchDir + ' with ' + str(self.numWorkers) + ' workers, output goes to ' + self.outBaseDir)
+        try:
+            while True:
+                self.scan()
+                self.writeStatus()
+                time.sleep(watchPollSeconds)
+        except KeyboardInterrupt:
+            print('Stopped watching ' + self.watchDir)
+
+emmcTargets = {}
+deltaBase = None
+
+if identifyOnly:
+    anyFailed = False
+    for inputFile in inputFiles:
+        try:
+            versionInfo = identify_firmware(inputFile, inFileType)
+        except SystemExit, e:
+            versionInfo = {'source': inputFile, 'error': str(e.code)}
+            anyFailed = True
+        except Exception, e:
+            versionInfo = {'source': inputFile, 'error': str(e)}
+            anyFailed = True
+        print(json.dumps(versionInfo, sort_keys=True))
+        sys.stdout.flush()
+    sys.exit(1 if anyFailed else 0)
+
+print_welcome()
+if len(watchDir) > 0:
+    if len(outBaseDir) == 0:
+        outBaseDir = os.path.join(watchDir, programName + '_output')
+    FolderWatcher(watchDir, outBaseDir, numWorkers).run()
+else:
+    if len(outBaseDir) == 0:
+        outBaseDir = os.getcwd()
+    emmcTargets = find_emmc_targets(emmcImagePath, boot0ImagePath, boot1ImagePath, rawnandImagePath)
+    if len(deltaBasePath) > 0:
+        deltaBase = load_delta_base(deltaBasePath)
+    convert_firmware(inputFiles[-1], inFileType, outBaseDir)